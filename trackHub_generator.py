@@ -8,16 +8,20 @@
 ## https://genome.ucsc.edu/goldenPath/help/trackDb/trackDbHub.html
 
 import argparse
+import concurrent.futures
 import os.path
-import glob
 import pprint
 import functools
 import re
 import yaml
 import sys
 
+try:
+    from yaml import CSafeDumper as SafeDumper, CSafeLoader as SafeLoader
+except ImportError:
+    from yaml import SafeDumper, SafeLoader
+
 args = None
-trackCounter = 1
 
 pp = pprint.PrettyPrinter()
 
@@ -146,6 +150,18 @@ bigbed_specific = {
         "visibility": "dense"},
     }
 
+## precompiled patterns, built once at import time
+BIGWIG_COLORS_COMPILED = tuple((re.compile(pat, re.IGNORECASE), color) for pat, color in bigwig_colors.items())
+BIGWIG_SPECIFIC_COMPILED = [(re.compile(".*("+pat+")", re.IGNORECASE), pat, cfg) for pat, cfg in bigwig_specific.items()]
+BIGBED_SPECIFIC_COMPILED = [(re.compile(".*("+pat+")", re.IGNORECASE), pat, cfg) for pat, cfg in bigbed_specific.items()]
+
+## pre-merged track templates, copied per track
+BIGWIG_DEFAULT_STANDALONE = {**bigwig_default, **bigwig_combined}
+BIGBED_DEFAULT = dict(bigbed_default)
+
+## supported track file extensions (lowercase) and their track kind
+EXT_TABLE = ((('.bw', '.bigwig'), 'bw'), (('.bb', '.bigbed'), 'bb'))
+
 composite_default = {"track": None,
                      "parent": None,
                      "type": None,
@@ -172,24 +188,113 @@ super_default = {"track": None,
 def get_directory_structure(rootdir, file_path):
     """
     Creates a nested dictionary that represents the folder structure of rootdir
+    
+    The directory skeleton is collected first, then the container configs are 
+    created in parallel (yaml config files are read per directory) and 
+    track ids are assigned afterwards by set_track_ids()
     """
     rootdir = rootdir.rstrip(os.sep)
     start = rootdir.rfind(os.sep) + 1
     dir= {"containers": [rootdir]} 
-    for path, dirs, files in os.walk(rootdir):
-        folders = path[start:].split(os.sep)
-
-        subdir = dict.fromkeys(files)
-        parent = functools.reduce(dict.get, folders[:-1], dir)
-        
-        config = get_container_config(path, folders, subdir, file_path)
-        
-        parent[folders[-1]] = {'containers': dirs}
-        parent[folders[-1]].update(config)
-        
+    containers = []
+    real_root = os.path.realpath(rootdir)
+    walk_directory(rootdir, [sys.intern(rootdir[start:])], dir, containers, real_root, {real_root})
+    
+    with concurrent.futures.ThreadPoolExecutor(max_workers=8) as executor:
+        futures = [executor.submit(get_container_config, path, parents, files, file_path) 
+                   for path, parents, files, node in containers]
+        for (path, parents, files, node), future in zip(containers, futures):
+            node.update(future.result())
+    
     return dir
 
 
+def walk_directory(path, parents, parent_dict, containers, real_path, seen):
+    """
+    Recursive top-down os.scandir walk that adds an empty container of 'path' to
+    'parent_dict', so the parent entry never has to be looked up again by name
+    
+    (path, parents, files, container) is appended to 'containers' for every directory
+    'real_path' is the resolved path of 'path', 'seen' holds the resolved paths of 
+    all directories on the current walk, used to detect directory link loops
+    """
+    dirs = []
+    real_dirs = []
+    files = []
+    with os.scandir(path) as it:
+        for entry in it:
+            ## linked container dirs are followed like real ones
+            if entry.is_dir():
+                if entry.is_symlink():
+                    real = os.path.realpath(entry.path)
+                    if real in seen:
+                        sys.exit("Linked directory {} points to a directory that is already part of its path!".format(entry.path))
+                else:
+                    real = real_path + os.sep + entry.name
+                ## container names are reused as dict keys and parent names
+                dirs.append(sys.intern(entry.name))
+                real_dirs.append(real)
+            else:
+                files.append(entry.name)
+
+    node = {'containers': dirs}
+    parent_dict[parents[-1]] = node
+    containers.append((path, parents, dict.fromkeys(files), node))
+
+    base = path + os.sep
+    for d, real in zip(dirs, real_dirs):
+        walk_directory(base + d, parents + [d], node, containers, real, seen | {real})
+
+
+def set_track_ids(hub, start_index):
+    """
+    Assigns numerical track ids to all tracks of 'hub', starting at 'start_index'
+    Containers and tracks are numbered in alphabetical order, so ids do not 
+    depend on the directory listing order of the file system
+    Every track file consumes an index, but tracks with a track name set by 
+    a config file keep that name
+    Returns the next free index
+    """
+    counter = start_index
+    for name in sorted(hub['containers']):
+        container = hub[name]
+        for track_file in sorted(container['tracks']):
+            kind = get_track_kind(track_file)
+            ## skip the container entry itself
+            if kind is None:
+                continue
+            track_config = container['tracks'][track_file]
+            if track_config.get('track') is None:
+                if kind == "bw":
+                    ## bigwig track names also carry the file name
+                    track_config["track"] = "_".join(["track",str(counter),track_file])
+                else:
+                    track_config["track"] = "_".join(["track",str(counter)])
+            counter += 1
+        counter = set_track_ids(container, counter)
+    return counter
+
+
+@functools.lru_cache(maxsize=8)
+def get_base_container(generatorType, is_top):
+    """
+    Returns the default container config for 'generatorType' (None for the root dir),
+    without 'parent' entry for toplevel containers
+    Callers must copy the returned dict before modifying it!
+    """
+    if generatorType == "multiwig":
+        base = {**multiwig_default, **bigwig_combined}
+    elif generatorType == "composite":
+        base = dict(composite_default)
+    elif generatorType == "super":
+        base = dict(super_default)
+    else:
+        base = {}
+    if is_top:
+        base.pop('parent', None)
+    return base
+
+
 def get_container_config(path, parents, files, file_path):
     """
     Creates a trackhub container and tracks config based on current 
@@ -208,38 +313,31 @@ def get_container_config(path, parents, files, file_path):
     Current code only supports *.bw|*.bigwig or *.bb|*.bigbed tracks!
     """    
     config = { 'tracks': {} }
-    container_config = {}    
     generatorType = None
     
-    if re.match(".*\.multiwig$",parents[-1],re.IGNORECASE):
-        container_config.update(multiwig_default)
-        container_config.update(bigwig_combined)
+    name_l = parents[-1].lower()
+    if name_l.endswith('.multiwig'):
         generatorType = "multiwig"
-    elif re.match(".*\.composite$",parents[-1],re.IGNORECASE):
-        container_config.update(composite_default)
+    elif name_l.endswith('.composite'):
         generatorType = "composite"
-    elif re.match(".*\.super$",parents[-1],re.IGNORECASE):
-        container_config.update(super_default)
+    elif name_l.endswith('.super'):
         generatorType = "super"
     elif len(parents)>1: 
         sys.exit("Every subdir needs to be a multiwig, composite or super container!")
+    
+    ## toplevel must not have a parent entry
+    is_top = len(parents)-2 <= 0
+    container_config = get_base_container(generatorType, is_top).copy()
         
     container_config["track"] = parents[-1]
     container_config["shortLabel"] = parents[-1]
     container_config["longLabel"] = parents[-1]
     
-    container_config["parent"] = parents[len(parents)-2]
+    if not is_top:
+        container_config["parent"] = parents[-2]
     
     if generatorType == "multiwig":
-        for pat in bigwig_specific:
-            if re.match(".*("+pat+")",container_config["track"],re.IGNORECASE):
-                print(" ".join(["match ",container_config["track"]," ",pat]))
-                container_config.update(bigwig_specific[pat])
-                break
-            
-    ## toplevel must not have a parent entry
-    if  len(parents)-2 <= 0:
-        container_config.pop('parent',None)
+        container_config.update(get_specific_config(container_config["track"], BIGWIG_SPECIFIC_COMPILED))
     
     config['tracks'][parents[-1]] = container_config
     
@@ -249,12 +347,10 @@ def get_container_config(path, parents, files, file_path):
     
     ## set type for specific containers 
     if generatorType == "composite" or generatorType == "multiwig":
-        tmp = set([v for k in tracks.keys() for kk,v in tracks[k].items() if kk == 'type'])
-        multi_track_type = 'bigWig'
-        if len(tmp)>0:
-            multi_track_type = tmp.pop()
-        if len(tmp) > 0:
+        types = {t['type'] for t in tracks.values() if 'type' in t}
+        if len(types) > 1:
             sys.exit("Only one tracktype allowed in composite or multiwig containers!")
+        multi_track_type = next(iter(types), 'bigWig')
         if generatorType == "multiwig" and multi_track_type != "bigWig":
             sys.exit("Only bigWig tracks are allowed in multiwig containers!")
         
@@ -262,11 +358,6 @@ def get_container_config(path, parents, files, file_path):
     
     ## update configs from config files if found (first *.yaml) in current path
     config = update_config_from_file(path, config)
-
-    ## just dump config of current container into its directory
-    ## file can be used as starting point to modify/add specific options
-    with open(os.path.join(path,"container_config.used"), 'w') as f:
-       yaml.dump(config['tracks'], f, default_flow_style=False)
     
     return config
 
@@ -282,69 +373,73 @@ def get_tracks_config(files, type, parents,file_path):
     
     """
     tracks_config = {}
-    global trackCounter
     
     for track_file in files:
-        track_config = {}
-        ## we have a bigwig file
-        if re.match(".*\.(bw|bigwig)$",track_file,re.IGNORECASE):
-            track_config.update(bigwig_default)
-            if type != "multiwig":
-                track_config.update(bigwig_combined)
-
-            ## toplevel tracks have no parent entry
-            if len(parents)-2 > -1:
-                track_config["parent"] = parents[-1]
-            else:
-                track_config.pop('parent',None)
-            
-            track_config["track"] = "_".join(["track",str(trackCounter),track_file]) ## add the 
-            track_config["bigDataUrl"] =  os.path.join( *parents[1:]+[track_file ]) 
+        kind = get_track_kind(track_file)
+        if kind is None:
+            continue
 
-            track_config["shortLabel"] = track_file  
-            track_config["longLabel"] = track_file
+        ## track ids are assigned after all containers are created, see set_track_ids()
+        if kind == "bw":
+            track_config = (bigwig_default if type == "multiwig" else BIGWIG_DEFAULT_STANDALONE).copy()
             track_config["color"] = get_bigwig_color(track_file,parents[-1])
-            trackCounter += 1
-            
-            if type != "multiwig":
-                for pat in bigwig_specific:
-                    if re.match(".*("+pat+")",track_file,re.IGNORECASE):
-                        print(" ".join(["match ",track_file," ",pat]))
-                        track_config.update(bigwig_specific[pat])
-                        break
-            
-            tracks_config[track_file] = track_config
-        ## we have a bigbed file
-        elif re.match(".*\.(bb|bigbed)$",track_file,re.IGNORECASE):
-            track_config.update(bigbed_default)
-            if len(parents)-2 > -1:
-                track_config["parent"] = parents[-1]
-            else:
-                track_config.pop('parent',None)
-            
-            track_config["track"] = "_".join(["track",str(trackCounter)])
-            track_config["bigDataUrl"] =  os.path.join( *parents[1:]+[track_file])
-     
-            track_config["shortLabel"] = track_file
-            track_config["longLabel"] = track_file
-            track_config["color"] = get_bigwig_color(track_file,parents[-1],bigbed_default['color'])
-            trackCounter += 1
-            
-            for pat in bigbed_specific:
-                if re.match(".*("+pat+")",track_file,re.IGNORECASE):
-                    print(" ".join(["match ",track_file," ",pat]))
-                    track_config.update(bigbed_specific[pat])
-                    break
-
-            tracks_config[track_file] = track_config
+        else:
+            track_config = BIGBED_DEFAULT.copy()
+            track_config["color"] = get_bigwig_color(track_file,parents[-1],BIGBED_DEFAULT['color'])
+
+        ## toplevel tracks have no parent entry
+        if len(parents)-2 > -1:
+            track_config["parent"] = parents[-1]
+        else:
+            track_config.pop('parent',None)
+
+        track_config["bigDataUrl"] =  os.path.join( *parents[1:]+[track_file])
+        track_config["shortLabel"] = track_file
+        track_config["longLabel"] = track_file
+
+        if kind == "bw":
+            if type != "multiwig" and BIGWIG_SPECIFIC_COMPILED:
+                track_config.update(get_specific_config(track_file, BIGWIG_SPECIFIC_COMPILED))
+        elif BIGBED_SPECIFIC_COMPILED:
+            track_config.update(get_specific_config(track_file, BIGBED_SPECIFIC_COMPILED))
+
+        tracks_config[track_file] = track_config
         
     return tracks_config
 
 
+def get_track_kind(track_file):
+    """
+    Returns the track kind ('bw' or 'bb') of 'track_file' or None if not supported
+    """
+    lower = track_file.lower()
+    for suffixes, kind in EXT_TABLE:
+        if lower.endswith(suffixes):
+            return kind
+    return None
+
+
+def get_specific_config(name, specific_compiled):
+    """
+    Returns the config of the first precompiled specific pattern matching 'name',
+    or an empty dict if none matches
+    """
+    for rx, pat, cfg in specific_compiled:
+        if rx.match(name):
+            ## single write, as containers are configured in parallel threads
+            sys.stdout.write(" ".join(["match ",name," ",pat]) + "\n")
+            return cfg
+    return {}
+
+
+@functools.lru_cache(maxsize=4096)
 def get_bigwig_color(filename, parent, default="255,0,0"):
     #print([filename,parent])
-    for pattern,color in bigwig_colors.items():
-        if (re.search(pattern, filename, re.IGNORECASE) or re.search(pattern, parent, re.IGNORECASE)):
+    ## one search per pattern over both names; '.' does not match the newline
+    ## separator, so a pattern can not match across filename and parent
+    hay = filename + "\n" + parent
+    for pattern,color in BIGWIG_COLORS_COMPILED:
+        if pattern.search(hay):
             #print(["match",pattern])
             return color
     return default
@@ -352,17 +447,18 @@ def get_bigwig_color(filename, parent, default="255,0,0"):
 
 def update_config_from_file(path, config):
     
-    ## take first yaml file that is found in path
-    config_files = glob.glob(os.path.join(path,"*.yaml"))
-    if config_files:
-        config_file = config_files[0]
-    else:
+    ## take first yaml file that is found in path (hidden files are skipped like glob does)
+    config_file = None
+    with os.scandir(path) as it:
+        for entry in it:
+            if entry.name.endswith('.yaml') and not entry.name.startswith('.') and entry.is_file():
+                config_file = entry.path
+                break
+    if config_file is None:
         return config 
     
-    configFromFile = {}
-    if os.path.isfile(config_file):
-        with open(config_file, "r") as f:
-            configFromFile = yaml.load(f)
+    with open(config_file, "r") as f:
+        configFromFile = yaml.load(f, Loader=SafeLoader)
      
     for tr in config['tracks']:
         if tr in configFromFile:
@@ -371,40 +467,84 @@ def update_config_from_file(path, config):
     return config
 
 
+def dump_container_configs(hub, path):
+    """
+    Dumps the used config of every container in 'hub' into its directory
+    as 'container_config.used'; file can be used as starting point to
+    modify/add specific options
+    """
+    for container in hub['containers']:
+        container_path = os.path.join(path, container)
+        with open(os.path.join(container_path,"container_config.used"), 'w') as f:
+           yaml.dump(hub[container]['tracks'], f, Dumper=SafeDumper, default_flow_style=False)
+        dump_container_configs(hub[container], container_path)
+
+
+def link_track(target, link):
+    """
+    Links 'target' to 'link', replacing an old link with the same name
+    Anything else than a symlink at 'link' is never removed!
+    """
+    try:
+        os.symlink(target, link)
+    except FileExistsError:
+        if not os.path.islink(link):
+            raise
+        os.unlink(link)
+        os.symlink(target, link)
+
+
 def write_hub(file, hub, depth, in_root, outdir,file_path):
+    """
+    Writes the trackDb config of 'hub' to 'file' and links all tracks into 'outdir'
+    'in_root' and 'outdir' are expected to be absolute paths, so they are
+    normalized only once by the caller and not per track
     
-    ## write out container config section
-    for container in hub['containers']:
+    The hub is traversed with an explicit stack: a container section is written
+    when the container is entered, its 'child' tracks after all sub-containers
+    """
+    links = {}
+    stack = [(hub, container, depth, False) for container in reversed(hub['containers'])]
+    
+    while stack:
+        node, container, level, entered = stack.pop()
+        child = node[container]
+        tracks = child['tracks']
         
-        if depth>0:
-            for k,v in hub[container]['tracks'][container].items():
-                file.write("{m: <{de}}".format(m='',de=str((depth-1)*5))) 
-                file.write("{} {}\n".format(k,v))
-            file.write("\n")
-            
-        write_hub(file, hub[container], depth+1, in_root, outdir, file_path)
+        if not entered:
+            ## write out container config section
+            if level>0:
+                pad = ' ' * ((level-1)*5)
+                lines = ["{}{} {}\n".format(pad,k,v) for k,v in tracks[container].items()]
+                lines.append("\n")
+                file.write(''.join(lines))
+            stack.append((node, container, level, True))
+            stack.extend((child, c, level+1, False) for c in reversed(child['containers']))
+            continue
         
-        ## write out all 'child' tracks of container
-        for track in hub[container]['tracks']:
+        ## write out all 'child' tracks of container at once
+        pad = ' ' * (level*5)
+        lines = []
+        for track, track_config in tracks.items():
             if container != track:
-                for k,v in hub[container]['tracks'][track].items():
+                for k,v in track_config.items():
                     if k=='bigDataUrl':
-                        v = hub[container]['tracks'][track][k].split(os.sep)[-1]
-                        v = file_path + v
-                    ## indentation
-                    file.write("{m: <{de}}".format(m='',de=str(depth*5)))
-                    file.write("{} {}\n".format(k,v))
-                ## remove link if we have on old link with same name
-                if os.path.islink(os.path.join(os.path.abspath(outdir),track)):
-                    os.remove(os.path.join(outdir,track))
-                ## link track into output dir
-                os.symlink(os.path.relpath(os.path.join(in_root,hub[container]['tracks'][track]['bigDataUrl']), outdir), os.path.join(outdir,track))
-                file.write("\n")
+                        v = file_path + v.split(os.sep)[-1]
+                    lines.append("{}{} {}\n".format(pad,k,v))
+                lines.append("\n")
+                ## a later track with the same name replaces the link, as before
+                links[os.path.join(outdir,track)] = os.path.relpath(os.path.join(in_root,track_config['bigDataUrl']), outdir)
+        file.write(''.join(lines))
+    
+    ## link all tracks into output dir, existing files that are no links are kept
+    with concurrent.futures.ThreadPoolExecutor() as executor:
+        try:
+            list(executor.map(link_track, links.values(), links.keys()))
+        except FileExistsError as e:
+            sys.exit("Cannot link track, {} exists and is not a link!".format(e.filename2))
 
 def main():
 
-    global trackCounter
-
     parser = argparse.ArgumentParser() 
     
     parser.add_argument("indir",
@@ -426,7 +566,8 @@ def main():
                         dest="startIndex",
                         default=1,
                         type=int,
-                        help="numerical index for first track, important if multiple trackDb files are used (default: '%(default)s')")
+                        help="numerical index for first track, important if multiple trackDb files are used; "
+                        "track ids are assigned in alphabetical container/track order (default: '%(default)s')")
     parser.add_argument("-f", "--file_path",
                         dest="filePath",
                         default='',
@@ -436,6 +577,12 @@ def main():
                         dest="postContent",
                         default='',
                         help="string/text that is inserted at the end of generated trackDb, use eg. 'include trackDb.test.txt' to include an additional track config file; Note: you likely need to specify -t -i when you generate 'trackDb.test.txt' ! (default: '%(default)s')")
+
+    parser.add_argument("--debug-dump",
+                        dest="debugDump",
+                        action="store_true",
+                        help="dump the used config of every container as 'container_config.used' into its directory; "
+                        "can be used as starting point to modify/add specific options (default: off)")
         
     args = parser.parse_args()
         
@@ -445,26 +592,29 @@ def main():
     print(args.outdir)
     print(os.path.abspath(args.indir))
     
-    trackCounter = args.startIndex
-    
     file_path = args.filePath
     
     print(file_path)
     
     ## get the hub by parsing directory structure
     hub = get_directory_structure(args.indir, file_path)
+    set_track_ids(hub, args.startIndex)
+
+    if args.debugDump:
+        dump_container_configs(hub, '')
 
     os.makedirs(args.outdir,exist_ok = True)
     
     ## write hub config to output dir and link all files for upload into it
-    with open(os.path.join(args.outdir,args.trackDbFilename), 'w') as f:
-        write_hub(f,hub,0, args.indir,args.outdir, file_path)
+    ## large buffer, trackDb is written in many small chunks
+    with open(os.path.join(args.outdir,args.trackDbFilename), 'w', buffering=1<<20) as f:
+        write_hub(f,hub,0, os.path.abspath(args.indir), os.path.abspath(args.outdir), file_path)
         f.write(args.postContent)
         f.close()
     
     ## just dump hub as yaml file for inspection/debugging
     with open(os.path.join(args.outdir,args.trackDbFilename+".hub_dict.yaml"), 'w') as f:
-       yaml.dump(hub, f, default_flow_style=False)
+       yaml.dump(hub, f, Dumper=SafeDumper, default_flow_style=False)
         
 
 if __name__ == "__main__":